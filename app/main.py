@@ -1,5 +1,9 @@
-from fastapi import FastAPI, UploadFile, File, Form, Request, Depends, Header, HTTPException
-from fastapi.responses import JSONResponse, HTMLResponse, RedirectResponse, FileResponse
+import asyncio
+import hmac
+import os
+
+from fastapi import FastAPI, UploadFile, File, Form, Request, Depends, Header, HTTPException, BackgroundTasks
+from fastapi.responses import ORJSONResponse, HTMLResponse, RedirectResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 from typing import List, Optional
@@ -7,15 +11,50 @@ import pandas as pd
 from fastapi.templating import Jinja2Templates
 from .optimizer import optimize_routes, build_map_html
 
-app = FastAPI(title="AI Logistics MVP – v3", version="0.3.0")
+app = FastAPI(title="AI Logistics MVP – v3", version="0.3.0", default_response_class=ORJSONResponse)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-API_KEY = "demo0123"
+API_KEY = os.getenv("API_KEY", "demo0123").encode()
+
+CSV_COLUMNS = {"id", "lat", "lng", "name", "demand", "tw_start", "tw_end"}
+
+def _read_stops_csv(f):
+    return pd.read_csv(
+        f,
+        usecols=lambda c: c in CSV_COLUMNS,
+        dtype={"id": str, "lat": "float64", "lng": "float64", "demand": "float64"}
+    )
+
+def _df_to_stops(df):
+    n = len(df)
+    if "demand" in df.columns:
+        demands = df["demand"].fillna(0).astype(int).tolist()
+    else:
+        demands = [0] * n
+    optional = {}
+    for col in ("name", "tw_start", "tw_end"):
+        if col in df.columns:
+            s = df[col].astype(object)
+            optional[col] = s.where(s.notna(), None).tolist()
+        else:
+            optional[col] = [None] * n
+    return list(zip(
+        df["id"].tolist(),
+        df["lat"].tolist(),
+        df["lng"].tolist(),
+        optional["name"],
+        demands,
+        optional["tw_start"],
+        optional["tw_end"]
+    ))
+
+def _render_map(result):
+    app.state.last_map_html = build_map_html(result)
 
 def require_api_key(x_api_key: str = Header(...)):
-    if x_api_key!= API_KEY:
-        raise HTTPException(status_code = 403, details = "Invalid API Key")
+    if not hmac.compare_digest((x_api_key or "").encode("utf-8"), API_KEY):
+        raise HTTPException(status_code = 403, detail = "Invalid API Key")
 
 class Location(BaseModel):
     lat: float
@@ -44,6 +83,7 @@ def home(request: Request):
 
 @app.post("/upload")
 async def upload(request: Request,
+                 background_tasks: BackgroundTasks,
                  file: UploadFile = File(...),
                  depot_lat: float = Form(51.5072),
                  depot_lng: float = Form(-0.1276),
@@ -51,24 +91,14 @@ async def upload(request: Request,
                  vehicle_capacity: int = Form(5),
                  depot_tw_start: str = Form("08:00"),
                  depot_tw_end: str = Form("18:00")):
-    df = pd.read_csv(file.file)
+    df = _read_stops_csv(file.file)
     requied_cols = {"id", "lat", "lng"}
     if not requied_cols.issubset(df.columns):
-        return JSONResponse(
+        return ORJSONResponse(
             {"error": "CSV must include id, lat, lng columns"},
             status_code = 400
         )
-    stops = []
-    for _, row in df.iterrows():
-        stops.append((
-            str(row.get("id")),
-            float(row["lat"]),
-            float(row["lng"]),
-            row.get("name"),
-            int(row.get("demand", 0)) if not pd.isna(row.get("demand", 0)) else 0,
-            str(row.get("tw_start")) if not pd.isna(row.get("tw_start")) else None,
-            str(row.get("tw_end")) if not pd.isna(row.get("tw_end")) else None
-        ))
+    stops = _df_to_stops(df)
     result = optimize_routes(
         depot=(float(depot_lat), float(depot_lng)),
         stops=stops,
@@ -77,7 +107,7 @@ async def upload(request: Request,
         depot_tw_start=depot_tw_start,
         depot_tw_end=depot_tw_end
     )
-    build_map_html(result, out_path="templates/route_map.html")
+    background_tasks.add_task(_render_map, result)
     request.app.state.last_result = result
     return RedirectResponse(url="/result", status_code=303)
 
@@ -87,7 +117,7 @@ def result_page(request: Request):
     return templates.TemplateResponse("result.html", {"request": request, "result": result})
 
 @app.post("/optimize")
-def optimize(req: OptimizeRequest, auth = Depends(require_api_key)):
+def optimize(req: OptimizeRequest, background_tasks: BackgroundTasks, auth = Depends(require_api_key)):
     stops = [(s.id, s.lat, s.lng, s.name, s.demand, s.tw_start, s.tw_end) for s in req.stops]
     result = optimize_routes(
         depot=(req.depot.lat, req.depot.lng),
@@ -97,11 +127,12 @@ def optimize(req: OptimizeRequest, auth = Depends(require_api_key)):
         depot_tw_start=req.depot_tw_start,
         depot_tw_end=req.depot_tw_end
     )
-    build_map_html(result, out_path="templates/route_map.html")
-    return JSONResponse(result)
+    background_tasks.add_task(_render_map, result)
+    return ORJSONResponse(result)
 
 @app.post("/optimize_csv")
-async def optimize_csv(file: UploadFile = File(...),
+async def optimize_csv(background_tasks: BackgroundTasks,
+                       file: UploadFile = File(...),
                        depot_lat: float = 51.5072,
                        depot_lng: float = -0.1276,
                        vehicle_count: int = 2,
@@ -109,23 +140,13 @@ async def optimize_csv(file: UploadFile = File(...),
                        depot_tw_start: str = "08:00",
                        depot_tw_end: str = "18:00",
                        auth = Depends(require_api_key)):
-    df = pd.read_csv(file.file)
+    df = _read_stops_csv(file.file)
     if len(df) > 500:
-        return JSONResponse(
+        return ORJSONResponse(
             {"error": "Too many stops (max 500 allowed)"},
             status_code = 400
         )
-    stops = []
-    for _, row in df.iterrows():
-        stops.append((
-            str(row.get("id")),
-            float(row["lat"]),
-            float(row["lng"]),
-            row.get("name"),
-            int(row.get("demand", 0)) if not pd.isna(row.get("demand", 0)) else 0,
-            str(row.get("tw_start")) if not pd.isna(row.get("tw_start")) else None,
-            str(row.get("tw_end")) if not pd.isna(row.get("tw_end")) else None
-        ))
+    stops = _df_to_stops(df)
     result = optimize_routes(
         depot=(float(depot_lat), float(depot_lng)),
         stops=stops,
@@ -134,33 +155,31 @@ async def optimize_csv(file: UploadFile = File(...),
         depot_tw_start=depot_tw_start,
         depot_tw_end=depot_tw_end
     )
-    build_map_html(result, out_path="templates/route_map.html")
-    return JSONResponse(result)
+    background_tasks.add_task(_render_map, result)
+    return ORJSONResponse(result)
 
 @app.get("/map")
 def get_map():
-    try:
-        with open("templates/route_map.html", "r", encoding="utf-8") as f:
-            html = f.read()
-        return HTMLResponse(content=html, status_code=200)
-    except FileNotFoundError:
+    html = getattr(app.state, "last_map_html", None)
+    if html is None:
         return HTMLResponse("<h3>No map generated yet. Upload/optimize first.</h3>")
+    return HTMLResponse(content=html, status_code=200)
 
 @app.get("/download")
-def download_results():
-    result = getattr(app,state, "last_result", None)
+async def download_results():
+    result = getattr(app.state, "last_result", None)
     if not result:
-        return JSONResponse(
+        return ORJSONResponse(
             {"error": "No results yet"},
             status_code = 404
         )
-    
+
     rows = []
     for v_idx, route in enumerate(result["routes"], start = 1):
         for stop in route:
             rows.append({"vehicle": v_idx, **stop})
     df = pd.DataFrame(rows)
 
-    file_path = "data/result.xlsx"
-    df.to_excel(file_path, index = False)
-    return FileResponse(file_path, fileName = "optimized_routes.xlsx")
\ No newline at end of file
+    file_path = "data/result.csv"
+    await asyncio.to_thread(df.to_csv, file_path, index = False)
+    return FileResponse(file_path, media_type = "text/csv", filename = "optimized_routes.csv")
\ No newline at end of file
@@ -1,6 +1,9 @@
 from typing import List, Tuple, Dict, Any, Optional
+from functools import lru_cache
 import math
 
+import numpy as np
+
 try:
     from ortools.constraint_solver import routing_enums_pb2
     from ortools.constraint_solver import pywrapcp
@@ -8,6 +11,22 @@ try:
 except Exception:
     HAVE_OR_TOOLS = False
 
+try:
+    from scipy.spatial import cKDTree
+    HAVE_SCIPY = True
+except Exception:
+    HAVE_SCIPY = False
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except Exception:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        def wrap(f):
+            return f
+        return wrap
+
 import folium
 
 LatLng = Tuple[float, float]
@@ -31,25 +50,102 @@ def parse_hhmm(hhmm: Optional[str]) -> Optional[int]:
     hh, mm = str(hhmm).split(":")
     return int(hh) * 60 + int(mm)
 
-def _greedy_order(depot: LatLng, stops: List[Stop]) -> List[int]:
-    visited = set()
-    order = []
-    curr = depot
-    while len(visited) < len(stops):
-        best_idx = None
-        best_dist = float("inf")
-        for i, s in enumerate(stops):
-            if i in visited:
+@njit(cache=True, fastmath=True)
+def _greedy_order_nb(depot_lat: float, depot_lng: float, lats: np.ndarray, lngs: np.ndarray) -> np.ndarray:
+    n = lats.shape[0]
+    order = np.empty(n, dtype=np.int32)
+    visited = np.zeros(n, dtype=np.bool_)
+    curr_lat = depot_lat
+    curr_lng = depot_lng
+    for k in range(n):
+        best_idx = -1
+        best_d2 = np.inf
+        coslat = math.cos(curr_lat)
+        for i in range(n):
+            if visited[i]:
                 continue
-            d = haversine_miles(curr, (s[1], s[2]))
-            if d < best_dist:
-                best_dist = d
+            dlat = lats[i] - curr_lat
+            dlon = (lngs[i] - curr_lng) * coslat
+            d2 = dlat*dlat + dlon*dlon
+            if d2 < best_d2:
+                best_d2 = d2
                 best_idx = i
-        visited.add(best_idx)
-        order.append(best_idx)
-        curr = (stops[best_idx][1], stops[best_idx][2])
+        visited[best_idx] = True
+        order[k] = best_idx
+        curr_lat = lats[best_idx]
+        curr_lng = lngs[best_idx]
     return order
 
+@lru_cache(maxsize=32)
+def _build_dist_matrix(coords: Tuple[LatLng, ...]) -> np.ndarray:
+    lat_r = np.radians(np.array([c[0] for c in coords]))
+    lng_r = np.radians(np.array([c[1] for c in coords]))
+    coslat = np.cos(lat_r)
+    dlat = lat_r[:, None] - lat_r[None, :]
+    dlon = lng_r[:, None] - lng_r[None, :]
+    h = np.sin(dlat / 2) ** 2 + coslat[:, None] * coslat[None, :] * np.sin(dlon / 2) ** 2
+    miles = 2 * 6371.0 * MILES_PER_KM * np.arcsin(np.sqrt(h))
+    return np.ascontiguousarray((miles * 1000).round().astype(np.int32))
+
+@lru_cache(maxsize=32)
+def _baseline_miles(coords: Tuple[LatLng, ...]) -> float:
+    if len(coords) < 2:
+        return 0.0
+    dist = _build_dist_matrix(coords)
+    baseline_mmiles = int(np.sum(np.diag(dist, 1)) + dist[-1, 0])
+    return round(baseline_mmiles / 1000.0, 2)
+
+@njit(cache=True)
+def _two_opt_nb(route: np.ndarray, dist: np.ndarray) -> np.ndarray:
+    n = route.shape[0]
+    improved = True
+    while improved:
+        improved = False
+        for i in range(1, n - 2):
+            for j in range(i + 1, n - 1):
+                a, b = route[i - 1], route[i]
+                c, d = route[j], route[j + 1]
+                if dist[a, c] + dist[b, d] < dist[a, b] + dist[c, d]:
+                    lo, hi = i, j
+                    while lo < hi:
+                        route[lo], route[hi] = route[hi], route[lo]
+                        lo += 1
+                        hi -= 1
+                    improved = True
+    return route
+
+def _greedy_order_kd(depot: LatLng, lats: np.ndarray, lngs: np.ndarray) -> List[int]:
+    n = lats.shape[0]
+    coslat = math.cos(math.radians(depot[0]))
+    pts = np.column_stack(((lngs - depot[1]) * coslat, lats - depot[0])).astype(np.float32)
+    tree = cKDTree(pts)
+    visited = np.zeros(n, dtype=bool)
+    order = []
+    curr = np.zeros(2, dtype=np.float32)
+    for _ in range(n):
+        nxt = -1
+        k = 32
+        while nxt < 0:
+            _, idxs = tree.query(curr, k=min(k, n))
+            for i in np.atleast_1d(idxs):
+                if i < n and not visited[i]:
+                    nxt = int(i)
+                    break
+            k *= 2
+        visited[nxt] = True
+        order.append(nxt)
+        curr = pts[nxt]
+    return order
+
+def _greedy_order(depot: LatLng, stops: List[Stop]) -> List[int]:
+    lats = np.array([s[1] for s in stops], dtype=np.float64)
+    lngs = np.array([s[2] for s in stops], dtype=np.float64)
+    if HAVE_SCIPY and len(stops) >= 200:
+        return _greedy_order_kd(depot, lats, lngs)
+    order = _greedy_order_nb(math.radians(depot[0]), math.radians(depot[1]),
+                             np.radians(lats), np.radians(lngs))
+    return [int(i) for i in order]
+
 def optimize_routes(
     depot: LatLng,
     stops: List[Stop],
@@ -69,6 +165,43 @@ def optimize_routes(
         }
 
     AVG_MPH = 20
+    coords = ((depot[0], depot[1]),) + tuple((s[1], s[2]) for s in stops)
+
+    no_stop_windows = all(parse_hhmm(s[5]) is None and parse_hhmm(s[6]) is None for s in stops)
+    if len(stops) == 1 or (len(stops) == 2 and no_stop_windows):
+        # Depot -> stops -> depot is already optimal (distances are
+        # symmetric), so skip the model build entirely. With two
+        # stops the input order is only safe when neither has a time
+        # window; otherwise fall through to the solver.
+        baseline_miles = _baseline_miles(coords)
+        demand_total = sum(max(0, s[4]) for s in stops)
+        if len(stops) == 2 and vehicle_count > 1 and demand_total > max(1, vehicle_capacity):
+            groups = [[0], [1]]
+        else:
+            groups = [list(range(len(stops)))]
+        dist = _build_dist_matrix(coords)
+        routes = []
+        total_mmiles = 0
+        for g in groups:
+            prev = 0
+            vehicle = []
+            for idx in g:
+                s = stops[idx]
+                vehicle.append({"id": s[0], "lat": s[1], "lng": s[2], "name": s[3], "demand": s[4]})
+                total_mmiles += int(dist[prev, idx + 1])
+                prev = idx + 1
+            total_mmiles += int(dist[prev, 0])
+            routes.append(vehicle)
+        total_miles = round(total_mmiles / 1000.0, 2)
+        savings_pct = round(((baseline_miles - total_miles) / baseline_miles * 100), 2) if baseline_miles > 0 else 0.0
+        return {
+            "engine": "direct",
+            "routes": routes,
+            "total_miles": total_miles,
+            "baseline_miles": baseline_miles,
+            "savings_pct": savings_pct,
+        }
+
     engine = "greedy-fallback"
     note = None
     routes: List[List[Dict[str, Any]]] = []
@@ -78,59 +211,33 @@ def optimize_routes(
         points = [("depot", depot[0], depot[1], "Depot", 0, depot_tw_start, depot_tw_end)] + stops
         n = len(points)
 
-        dist_mmile = [[0] * n for _ in range(n)]
-        for i in range(n):
-            ai = (points[i][1], points[i][2])
-            for j in range(n):
-                if i == j:
-                    continue
-                bj = (points[j][1], points[j][2])
-                miles = haversine_miles(ai, bj)
-                dist_mmile[i][j] = int(round(miles * 1000))
+        dist_mmile = _build_dist_matrix(coords)
 
         manager = pywrapcp.RoutingIndexManager(n, vehicle_count, 0)
-        routing = pywrapcp.RoutingModel(manager)
-
-        def distance_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            return dist_mmile[from_node][to_node]
+        model_params = pywrapcp.DefaultRoutingModelParameters()
+        model_params.max_callback_cache_size = n * n
+        model_params.reduce_vehicle_cost_model = True
+        routing = pywrapcp.RoutingModel(manager, model_params)
 
-        transit_cb_idx = routing.RegisterTransitCallback(distance_callback)
+        transit_cb_idx = routing.RegisterTransitMatrix(dist_mmile.tolist())
         routing.SetArcCostEvaluatorOfAllVehicles(transit_cb_idx)
 
         demands = [0] + [max(0, s[4]) for s in stops]
-
-        def demand_callback(from_index):
-            node = manager.IndexToNode(from_index)
-            return demands[node]
-
-        demand_cb_idx = routing.RegisterUnaryTransitCallback(demand_callback)
+        demand_cb_idx = routing.RegisterUnaryTransitVector(demands)
         routing.AddDimensionWithVehicleCapacity(
             demand_cb_idx, 0, [max(1, vehicle_capacity)] * vehicle_count, True, "Capacity"
         )
 
-        def travel_time_callback(from_index, to_index):
-            from_node = manager.IndexToNode(from_index)
-            to_node = manager.IndexToNode(to_index)
-            mmiles = dist_mmile[from_node][to_node]
-            miles = mmiles / 1000.0
-            minutes = int(miles / (AVG_MPH / 60.0))
-            return minutes
-
-        time_cb_idx = routing.RegisterTransitCallback(travel_time_callback)
+        time_mat = (dist_mmile * (60.0 / (AVG_MPH * 1000.0))).astype(np.int32)
+        time_cb_idx = routing.RegisterTransitMatrix(time_mat.tolist())
         horizon = 24 * 60
         routing.AddDimension(time_cb_idx, 30, horizon, False, "Time")
         time_dim = routing.GetDimensionOrDie("Time")
 
-        depot_start = parse_hhmm(depot_tw_start) or 0
-        depot_end = parse_hhmm(depot_tw_end) or horizon
-        time_dim.CumulVar(manager.NodeToIndex(0)).SetRange(depot_start, depot_end)
-
-        for i in range(1, n):
-            start = parse_hhmm(points[i][5]) or 0
-            end = parse_hhmm(points[i][6]) or horizon
-            time_dim.CumulVar(manager.NodeToIndex(i)).SetRange(start, end)
+        tws_arr = np.array([parse_hhmm(p[5]) or 0 for p in points], dtype=np.int32)
+        twe_arr = np.array([parse_hhmm(p[6]) or horizon for p in points], dtype=np.int32)
+        for i in range(n):
+            time_dim.CumulVar(manager.NodeToIndex(i)).SetRange(int(tws_arr[i]), int(twe_arr[i]))
 
         for v in range(vehicle_count):
             routing.AddVariableMinimizedByFinalizer(time_dim.CumulVar(routing.Start(v)))
@@ -139,7 +246,10 @@ def optimize_routes(
         search_params = pywrapcp.DefaultRoutingSearchParameters()
         search_params.first_solution_strategy = routing_enums_pb2.FirstSolutionStrategy.PATH_CHEAPEST_ARC
         search_params.local_search_metaheuristic = routing_enums_pb2.LocalSearchMetaheuristic.GUIDED_LOCAL_SEARCH
-        search_params.time_limit.FromSeconds(5)
+        # Small instances reach good solutions well under the old flat
+        # 5s limit; scale it with instance size instead of always
+        # paying the full budget.
+        search_params.time_limit.FromSeconds(max(1, min(5, int(0.02 * len(stops)))))
 
         solution = routing.SolveWithParameters(search_params)
         if solution:
@@ -156,10 +266,10 @@ def optimize_routes(
                         vehicle_route.append({
                             "id": sid, "lat": lat, "lng": lng, "name": name, "demand": demand
                         })
-                        total_mmiles += dist_mmile[prev][node]
+                        total_mmiles += int(dist_mmile[prev, node])
                         prev = node
                     index = solution.Value(routing.NextVar(index))
-                total_mmiles += dist_mmile[prev][0]
+                total_mmiles += int(dist_mmile[prev, 0])
                 if vehicle_route:
                     routes.append(vehicle_route)
             total_miles = round(total_mmiles / 1000.0, 2)
@@ -172,30 +282,25 @@ def optimize_routes(
         for idx, s_idx in enumerate(order):
             buckets[idx % len(buckets)].append(s_idx)
 
+        dist = _build_dist_matrix(coords)
         routes = []
-        total = 0.0
+        total_mmiles = 0
         for b in buckets:
-            curr = depot
+            if not b:
+                continue
+            tour = np.array([0] + [i + 1 for i in b] + [0], dtype=np.int32)
+            tour = _two_opt_nb(tour, dist)
             vehicle = []
-            for idx in b:
-                s = stops[idx]
-                total += haversine_miles(curr, (s[1], s[2]))
-                curr = (s[1], s[2])
+            for node in tour[1:-1]:
+                s = stops[int(node) - 1]
                 vehicle.append({"id": s[0], "lat": s[1], "lng": s[2], "name": s[3], "demand": s[4]})
-            total += haversine_miles(curr, depot)
-            if vehicle:
-                routes.append(vehicle)
-        total_miles = round(total, 2)
+            total_mmiles += int(np.sum(dist[tour[:-1], tour[1:]]))
+            routes.append(vehicle)
+        total_miles = round(total_mmiles / 1000.0, 2)
         if note is None:
             note = "Install OR-Tools to enforce capacity/time windows exactly."
 
-    baseline = 0.0
-    curr = depot
-    for s in stops:
-        baseline += haversine_miles(curr, (s[1], s[2]))
-        curr = (s[1], s[2])
-    baseline += haversine_miles(curr, depot)
-    baseline_miles = round(baseline, 2)
+    baseline_miles = _baseline_miles(coords)
 
     savings_pct = round(((baseline_miles - total_miles) / baseline_miles * 100), 2) if baseline_miles > 0 else 0.0
 
@@ -210,27 +315,26 @@ def optimize_routes(
         result["note"] = note
     return result
 
-def build_map_html(result: Dict[str, Any], out_path: str = "templates/route_map.html") -> str:
-    all_points = []
-    for route in result.get("routes", []):
-        for s in route:
-            all_points.append((s["lat"], s["lng"]))
-    if not all_points:
-        all_points = [(51.5072, -0.1276)]
-    center = (sum(p[0] for p in all_points)/len(all_points), sum(p[1] for p in all_points)/len(all_points))
+def build_map_html(result: Dict[str, Any]) -> str:
+    routes = [r for r in result.get("routes", []) if r]
+    route_coords = [np.array([(s["lat"], s["lng"]) for s in r]) for r in routes]
+    all_coords = np.concatenate(route_coords) if route_coords else np.array([(51.5072, -0.1276)])
+    center = tuple(all_coords.mean(axis=0))
     m = folium.Map(location=center, zoom_start=12)
-    for r_idx, route in enumerate(result.get("routes", []), start=1):
-        coords = []
-        for i, s in enumerate(route, start=1):
-            folium.Marker(
-                location=(s["lat"], s["lng"]),
-                popup=f"Veh {r_idx} · Stop {i}: {s.get('name') or s['id']} (demand={s.get('demand',0)})",
-                tooltip=f"{s.get('name') or s['id']}"
-            ).add_to(m)
-            coords.append((s["lat"], s["lng"]))
+    if len(all_coords) > 200:
+        from folium.plugins import FastMarkerCluster
+        m.add_child(FastMarkerCluster(all_coords.tolist()))
+    else:
+        fg = folium.FeatureGroup(name="stops")
+        for r_idx, route in enumerate(routes, start=1):
+            for i, s in enumerate(route, start=1):
+                fg.add_child(folium.Marker(
+                    location=(s["lat"], s["lng"]),
+                    popup=f"Veh {r_idx} · Stop {i}: {s.get('name') or s['id']} (demand={s.get('demand',0)})",
+                    tooltip=f"{s.get('name') or s['id']}"
+                ))
+        m.add_child(fg)
+    for coords in route_coords:
         if len(coords) >= 2:
-            folium.PolyLine(locations=coords).add_to(m)
-    import os
-    os.makedirs(os.path.dirname(out_path), exist_ok=True)
-    m.save(out_path)
-    return out_path
+            m.add_child(folium.PolyLine(locations=coords.tolist()))
+    return m.get_root().render()
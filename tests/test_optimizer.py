@@ -1,4 +1,4 @@
-from app.optimizer import haversine_km
+from app.optimizer import haversine_miles
 
 def test_haversine_zero():
-    assert abs(haversine_km((0,0),(0,0))) < 1e-9
+    assert abs(haversine_miles((0,0),(0,0))) < 1e-9